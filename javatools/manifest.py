@@ -28,13 +28,14 @@ References
 
 import hashlib
 import os
+import re
 import sys
 
-from base64 import b64encode
-from collections import OrderedDict
-from cStringIO import StringIO
-from itertools import izip
-from os.path import isdir, join, sep, split, walk
+from binascii import b2a_base64
+from collections import deque
+from itertools import chain, izip
+from os import walk
+from os.path import isdir, join, sep, split
 from zipfile import ZipFile
 
 from .change import GenericChange, SuperChange
@@ -42,6 +43,25 @@ from .change import Addition, Removal
 from .dirutils import fnmatches, makedirsp
 
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+try:
+    from sys import intern
+except ImportError:
+    # a builtin in Python 2
+    pass
+
+if sys.version_info < (3, 7):
+    from collections import OrderedDict as _OrderedDict
+else:
+    # a plain dict keeps insertion order from 3.7 onward, without the
+    # extra bookkeeping of an OrderedDict
+    _OrderedDict = dict
+
+
 __all__ = (
     "ManifestChange", "ManifestSectionChange",
     "ManifestSectionAdded", "ManifestSectionRemoved",
@@ -53,7 +73,16 @@ __all__ = (
 )
 
 
-_BUFFERING = 2 ** 14
+_BUFFERING = 2 ** 18
+
+
+# a single line break, any of those permitted by the JAR specification
+_LINEBREAK = r"(?:\r\n|\r(?!\n)|\n)"
+
+_RE_LINEBREAK = re.compile(_LINEBREAK)
+
+# consecutive line breaks, ie. the blank lines separating sections
+_RE_SECTION_BREAK = re.compile(_LINEBREAK + "{2,}")
 
 
 
@@ -107,6 +136,50 @@ _add_digest("SHA-384", "sha384")
 _add_digest("SHA-512", "sha512")
 
 
+# Java name of the digest to use for signatures when none is
+# requested, as picked by preferred_digest
+_PREFERRED_DIGEST = None
+
+def preferred_digest():
+    """
+    The Java name of the faster of SHA-256 and SHA-512 on this host.
+    SHA-512 works on 64-bit words and tends to outpace SHA-256 on
+    64-bit CPUs that lack dedicated SHA-256 instructions. The choice is
+    made by timing both over the same data, once per process.
+    """
+
+    global _PREFERRED_DIGEST
+
+    if _PREFERRED_DIGEST is None:
+        _PREFERRED_DIGEST = "SHA-256"
+
+        if sys.maxsize > 2 ** 32 and "SHA-512" in NAMED_DIGESTS:
+            from timeit import default_timer
+
+            data = "\x00" * 2 ** 16
+            timings = []
+            for java_name in ("SHA-256", "SHA-512"):
+                digest = NAMED_DIGESTS[java_name]
+                start = default_timer()
+                for _i in xrange(8):
+                    digest(data).digest()
+                timings.append((default_timer() - start, java_name))
+
+            _PREFERRED_DIGEST = min(timings)[1]
+
+    return _PREFERRED_DIGEST
+
+
+def _changed_keys(left, right):
+    """
+    the set of keys whose values differ between the left and right
+    sections, including those keys present in only one of them
+    """
+
+    return set(k for k in set(left).union(right)
+               if left.get(k) != right.get(k))
+
+
 class ManifestSectionChange(GenericChange):
     label = "Manifest Subsection"
 
@@ -126,10 +199,7 @@ class ManifestSectionChange(GenericChange):
 
         ikeys = set(getattr(options, "ignore_manifest_key", set()))
         if ikeys:
-            lset = set(self.ldata.items())
-            rset = set(self.rdata.items())
-            changed = set(k for k,v in lset.symmetric_difference(rset))
-            return changed.issubset(ikeys)
+            return _changed_keys(self.ldata, self.rdata).issubset(ikeys)
 
         else:
             return False
@@ -174,10 +244,7 @@ class ManifestMainChange(GenericChange):
     def is_ignored(self, options):
         ikeys = set(getattr(options, "ignore_manifest_key", set()))
         if ikeys:
-            lset = set(self.ldata.items())
-            rset = set(self.rdata.items())
-            changed = set(k for k,v in lset.symmetric_difference(rset))
-            return changed.issubset(ikeys)
+            return _changed_keys(self.ldata, self.rdata).issubset(ikeys)
 
         else:
             return False
@@ -210,13 +277,17 @@ class ManifestChange(SuperChange):
             SuperChange.is_ignored(self, options)
 
 
-class ManifestSection(OrderedDict):
+class ManifestSection(_OrderedDict):
 
     primary_key = "Name"
 
 
     def __init__(self, name=None):
-        OrderedDict.__init__(self)
+        # serialized forms of this section, by line separator. Cleared
+        # whenever the section is modified.
+        self._serialized = {}
+
+        _OrderedDict.__init__(self)
         self[self.primary_key] = name
 
 
@@ -227,12 +298,36 @@ class ManifestSection(OrderedDict):
 
         # our keys should always be strings, as should our values. We
         # also have an upper limit on the length we can permit for
-        # keys, per the JAR MANIFEST specification.
-        k = str(k)
+        # keys, per the JAR MANIFEST specification. The same few keys
+        # ("Name", "SHA-256-Digest", etc.) appear in nearly every
+        # section, so they're interned to share a single copy of each.
+        k = intern(str(k))
         if len(k) > 68:
             raise ManifestKeyException("key too long", k)
         else:
-            OrderedDict.__setitem__(self, k, str(v))
+            self._serialized.clear()
+            _OrderedDict.__setitem__(self, k, str(v))
+
+
+    def __delitem__(self, k):
+        #pylint: disable=W0221
+        # we want the behavior of OrderedDict, but don't take the
+        # additional parameter
+
+        self._serialized.clear()
+        _OrderedDict.__delitem__(self, k)
+
+
+    def clear(self):
+        self._serialized.clear()
+        _OrderedDict.clear(self)
+
+
+    # the dict versions of these would bypass our __setitem__ and
+    # __delitem__, and so the key checks and the serialized cache
+    update = MutableMapping.update
+    setdefault = MutableMapping.setdefault
+    pop = MutableMapping.pop
 
 
     def primary(self):
@@ -257,20 +352,34 @@ class ManifestSection(OrderedDict):
         Serialize this section and write it to a stream
         """
 
+        stream.write(self.get_data(linesep))
+
+
+    def store_parts(self, parts, linesep=os.linesep):
+        """
+        Serialize this section, appending the pieces of it to the list
+        parts. Joining the list gives the serialized section.
+        """
+
         for k, v in self.items():
-            write_key_val(stream, k, v, linesep)
+            append_key_val(parts, k, v, linesep)
 
-        stream.write(linesep)
+        parts.append(linesep)
 
 
     def get_data(self, linesep=os.linesep):
         """
-        Serialize the section and return it as a string
+        Serialize the section and return it as a string. The result is
+        kept until the section is next modified.
         """
 
-        stream = StringIO()
-        self.store(stream, linesep)
-        return stream.getvalue()
+        data = self._serialized.get(linesep)
+        if data is None:
+            parts = []
+            self.store_parts(parts, linesep)
+            data = self._serialized[linesep] = "".join(parts)
+
+        return data
 
 
     def keys_with_suffix(self, suffix):
@@ -296,7 +405,7 @@ class Manifest(ManifestSection):
     def __init__(self, version="1.0", linesep=None):
         # can't use super, because we're a child of a non-object
         ManifestSection.__init__(self, version)
-        self.sub_sections = OrderedDict([])
+        self.sub_sections = _OrderedDict()
         self.linesep = linesep
 
 
@@ -326,8 +435,8 @@ class Manifest(ManifestSection):
         Parse the given file, and attempt to detect the line separator.
         """
 
-        with open(filename, "r", _BUFFERING) as stream:
-            self.parse(stream)
+        with open(filename, "r") as stream:
+            self.parse(stream.read())
 
 
     def parse(self, data):
@@ -336,6 +445,11 @@ class Manifest(ManifestSection):
         stream, string, or buffer
         """
 
+        # a stream is read in its entirety, so that the sections can
+        # be split out of it in bulk rather than a line at a time
+        if hasattr(data, "read"):
+            data = data.read()
+
         self.linesep = detect_linesep(data)
 
         # the first section is the main one for the manifest. It's
@@ -352,16 +466,16 @@ class Manifest(ManifestSection):
 
     def store(self, stream, linesep=None):
         """
-        Serialize the Manifest to a stream
+        Serialize the Manifest to a stream, one section at a time
         """
 
         # either specified here, specified on the instance, or the OS
         # default
         linesep = linesep or self.linesep or os.linesep
 
-        ManifestSection.store(self, stream, linesep)
+        stream.write(ManifestSection.get_data(self, linesep))
         for sect in sorted(self.sub_sections.values()):
-            sect.store(stream, linesep)
+            stream.write(sect.get_data(linesep))
 
 
     def get_main_section(self, linesep=None):
@@ -372,9 +486,7 @@ class Manifest(ManifestSection):
 
         linesep = linesep or self.linesep or os.linesep
 
-        stream = StringIO()
-        ManifestSection.store(self, stream, linesep)
-        return stream.getvalue()
+        return ManifestSection.get_data(self, linesep)
 
 
     def get_data(self, linesep=None):
@@ -382,11 +494,15 @@ class Manifest(ManifestSection):
         Serialize the entire manifest and return it as a string
         """
 
+        # either specified here, specified on the instance, or the OS
+        # default
         linesep = linesep or self.linesep or os.linesep
 
-        stream = StringIO()
-        self.store(stream, linesep)
-        return stream.getvalue()
+        parts = [ManifestSection.get_data(self, linesep)]
+        for sect in sorted(self.sub_sections.values()):
+            parts.append(sect.get_data(linesep))
+
+        return "".join(parts)
 
 
     def verify_jar_checksums(self, jar_file):
@@ -421,21 +537,13 @@ class Manifest(ManifestSection):
 
     def clear(self):
         """
-        removes all items from this manifest, and clears and removes all
-        sub-sections
+        removes all items and all sub-sections from this manifest
         """
 
-        for sub in self.sub_sections.values():
-            sub.clear()
         self.sub_sections.clear()
-
         ManifestSection.clear(self)
 
 
-    def __del__(self):
-        self.clear()
-
-
 class SignatureManifest(Manifest):
     """
     Represents a KEY.SF signature file.  Structure is similar to that
@@ -446,13 +554,16 @@ class SignatureManifest(Manifest):
     primary_key = "Signature-Version"
 
 
-    def digest_manifest(self, manifest, java_algorithm="SHA-256"):
+    def digest_manifest(self, manifest, java_algorithm=None):
         """
         Create a main section checksum and sub-section checksums based off
         of the data from an existing manifest using an algorithm given
-        by Java-style name.
+        by Java-style name. If no algorithm is given, the one chosen by
+        preferred_digest is used.
         """
 
+        java_algorithm = java_algorithm or preferred_digest()
+
         # pick a line separator for creating checksums of the manifest
         # contents. We want to use either the one from the given
         # manifest, or the OS default if it hasn't specified one.
@@ -469,26 +580,37 @@ class SignatureManifest(Manifest):
         # calculate the checksum for the main manifest section. We'll
         # be re-using this digest to also calculate the total
         # checksum.
-        h_all = digest()
-        h_all.update(manifest.get_main_section())
-        self[main_key] = b64encode(h_all.digest())
+        h_all = digest(manifest.get_main_section())
+        self[main_key] = _b64(h_all.digest())
+
+        # section data waiting to be pushed into the total. It's
+        # gathered up to feed the total digest in large updates rather
+        # than one per section, without ever holding the whole
+        # manifest in memory at once.
+        pending = []
+        pending_size = 0
 
         for sub_section in manifest.sub_sections.values():
             sub_data = sub_section.get_data(linesep)
 
             # create the checksum of the section body and store it as a
             # sub-section of our own
-            h_section = digest()
-            h_section.update(sub_data)
             sf_sect = self.create_section(sub_section.primary())
-            sf_sect[sect_key] = b64encode(h_section.digest())
+            sf_sect[sect_key] = _b64(digest(sub_data).digest())
 
-            # push this data into this total as well.
-            h_all.update(sub_data)
+            pending.append(sub_data)
+            pending_size += len(sub_data)
+            if pending_size >= _BUFFERING:
+                h_all.update("".join(pending))
+                pending = []
+                pending_size = 0
+
+        # push the remaining section data into the total as well.
+        h_all.update("".join(pending))
 
         # after traversing all the sub sections, we now have the
         # digest of the whole manifest.
-        self[all_key] = b64encode(h_all.digest())
+        self[all_key] = _b64(h_all.digest())
 
 
     def verify_manifest_checksums(self, manifest):
@@ -599,6 +721,7 @@ class SignatureManifest(Manifest):
         # not intended to be interpreted by humans"
 
         from subprocess import Popen, PIPE, CalledProcessError
+        from threading import Thread
 
         JAVA_TO_OPENSSL_DIGESTS = {
             "MD5": "MD5",
@@ -617,10 +740,46 @@ class SignatureManifest(Manifest):
                        " -signer %s -inkey %s -outform der" \
                        % (openssl_digest, certificate, private_key)
 
+        # serialize every section before openssl is started, so that
+        # any problem doing so is raised from here rather than leaving
+        # openssl to sign whatever had been written. Each section keeps
+        # its serialized data, so they're handed over one at a time
+        # without being joined into a single string.
+        linesep = self.linesep or os.linesep
+        sections = [self.get_main_section(linesep)]
+        sections.extend(sect.get_data(linesep)
+                        for sect in sorted(self.sub_sections.values()))
+
         proc = Popen(external_cmd.split(),
                      stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
-        (proc_stdout, proc_stderr) = proc.communicate(input=self.get_data())
+        failure = []
+
+        def feed(stdin):
+            try:
+                for data in sections:
+                    stdin.write(data)
+            except IOError:
+                # openssl quit early, and its exit code and stderr
+                # will tell us why
+                pass
+            except Exception:
+                failure.append(sys.exc_info())
+            finally:
+                stdin.close()
+
+        # the sections are written to openssl from a thread of their
+        # own, while communicate collects its output
+        stdin, proc.stdin = proc.stdin, None
+        feeder = Thread(target=feed, args=(stdin,))
+        feeder.start()
+
+        (proc_stdout, proc_stderr) = proc.communicate()
+        feeder.join()
+
+        if failure:
+            exc_type, exc_value, exc_tb = failure[0]
+            raise exc_type, exc_value, exc_tb
 
         if proc.returncode != 0:
             print proc_stderr
@@ -629,76 +788,92 @@ class SignatureManifest(Manifest):
             return proc_stdout
 
 
+def _b64(raw):
+    """
+    base64 encodes raw, for storing a digest in a manifest. This calls
+    binascii.b2a_base64 directly, rather than going through
+    base64.b64encode which only wraps it, and slices off the newline
+    that b2a_base64 appends.
+    """
+
+    return b2a_base64(raw)[:-1]
+
+
 def b64_encoded_digest(data, algorithm):
     h = algorithm()
     h.update(data)
-    return b64encode(h.digest())
+    return _b64(h.digest())
 
 def detect_linesep(data):
-    if isinstance(data, (str, buffer)):
-        data = StringIO(data)
+    """
+    returns the line separator used by the first line of data, a
+    string, buffer, or stream. A stream is read from its current
+    position, which is restored afterwards.
+    """
 
-    offset = data.tell()
-    line = data.readline()
-    data.seek(offset)
+    if not isinstance(data, (str, buffer)):
+        offset = data.tell()
+        text = data.read()
+        data.seek(offset)
+        data = text
 
-    if line[-2:] == "\r\n":
-        return "\r\n"
+    data = str(data)
+    brk = _RE_LINEBREAK.search(data)
+    if brk:
+        return brk.group()
     else:
-        return line[-1]
+        return data[-1]
 
 
 def parse_sections(data):
     """
     yields one section at a time in the form
 
-    [ (key, [val, ...]), ... ]
+    [ (key, [val]), ... ]
 
-    where key is a string and val is a string representing a single
-    line of any value associated with the key. Multiple vals may be
-    present if the value is long enough to require line continuations
-    in which case simply concatenate the vals together to get the full
-    value.
+    where key is a string and val is a string holding the full value
+    associated with the key, with any line continuations already
+    joined together. data may be a string, buffer, or stream, and a
+    stream is read in its entirety.
     """
 
+    if not isinstance(data, (str, buffer)):
+        data = data.read()
+
     if not data:
         return
 
-    if isinstance(data, (str, buffer)):
-        data = StringIO(data)
-
-    # our current section
-    curr = None
+    data = str(data).replace('\x00', '')
 
-    for lineno,line in enumerate(data):
-        # Clean up the line
-        cleanline = line.splitlines()[0].replace('\x00', '')
+    start = 0
+    for brk in chain(_RE_SECTION_BREAK.finditer(data), (None,)):
+        end = brk.start() if brk else len(data)
 
-        if not cleanline:
-            # blank line means end of current section (if any)
-            if curr:
-                yield curr
-                curr = None
+        # a lone line break at the very start of the data is a blank
+        # line which doesn't separate any sections
+        section = data[start:end].lstrip("\r\n")
 
-        elif cleanline[0] == ' ':
-            # line beginning with a space means a continuation
-            if curr is None:
+        if section:
+            if section[0] == ' ':
+                offset = end - len(section)
+                lineno = len(_RE_LINEBREAK.findall(data, 0, offset))
                 raise MalformedManifest("bad line continuation, "
                                         " line: %i" % lineno)
-            else:
-                curr[-1][1].append(cleanline[1:])
 
-        else:
-            # otherwise the beginning of a new k:v pair
-            if curr is None:
-                curr = list()
+            # the separator following each key is dropped before any
+            # continuations are joined on to its value
+            entries = []
+            for line in section.splitlines():
+                if line[0] == ' ':
+                    entries[-1][1].append(line[1:])
+                else:
+                    key, val = line.split(':', 1)
+                    entries.append((key, [val[1:]]))
 
-            key, val = cleanline.split(':', 1)
-            curr.append((key, [val[1:]]))
+            yield [(key, ["".join(vals)]) for key, vals in entries]
 
-    # yield and leftovers
-    if curr:
-        yield curr
+        if brk:
+            start = brk.end()
 
 
 def write_key_val(stream, key, val, linesep=os.linesep):
@@ -709,6 +884,17 @@ def write_key_val(stream, key, val, linesep=os.linesep):
     continuing lines
     """
 
+    parts = []
+    append_key_val(parts, key, val, linesep)
+    stream.write("".join(parts))
+
+
+def append_key_val(parts, key, val, linesep=os.linesep):
+    """
+    As write_key_val, but appends the pieces of the serialized key and
+    value pair to the list parts rather than writing them to a stream
+    """
+
     key = key or ""
     val = val or ""
 
@@ -716,99 +902,172 @@ def write_key_val(stream, key, val, linesep=os.linesep):
         raise ManifestKeyException("bad key length", key)
 
     if len(key) + len(val) > 68:
-        kvbuffer = StringIO(": ".join((key, val)))
+        kv = ": ".join((key, val))
 
         # first grab 70 (which is 72 after the trailing newline)
-        stream.write(kvbuffer.read(70))
+        parts.append(kv[:70])
 
         # now only 69 at a time, because we need a leading space and a
         # trailing \n
-        part = kvbuffer.read(69)
-        while part:
-            stream.write(linesep + " ")
-            stream.write(part)
-            part = kvbuffer.read(69)
-        kvbuffer.close()
+        for offset in xrange(70, len(kv), 69):
+            parts.append(linesep + " ")
+            parts.append(kv[offset:offset + 69])
 
     else:
-        stream.write(key)
-        stream.write(": ")
-        stream.write(val)
+        parts.append(key)
+        parts.append(": ")
+        parts.append(val)
 
-    stream.write(linesep)
+    parts.append(linesep)
 
 
-def digest_chunks(chunks, algorithms=(hashlib.md5, hashlib.sha1)):
+def digest_stream(stream, algorithms=(hashlib.md5, hashlib.sha1),
+                  buf=None):
     """
     returns a base64 rep of the given digest algorithms from the
-    chunks of data
+    contents of a readable stream. The stream is read only once, into
+    a single buffer which is fed to each of the digests in turn, so no
+    intermediary chunk strings are created. buf may be a bytearray to
+    read into, which lets callers digesting many streams share one.
     """
 
     hashes = [algorithm() for algorithm in algorithms]
 
-    for chunk in chunks:
+    if buf is None:
+        buf = bytearray(_BUFFERING)
+    view = memoryview(buf)
+
+    count = stream.readinto(buf)
+    while count:
+        chunk = view[:count]
         for h in hashes:
             h.update(chunk)
+        count = stream.readinto(buf)
+
+    return [_b64(h.digest()) for h in hashes]
+
+
+def file_stream(filename):
+    """
+    returns a function which when called will open filename for
+    reading and return the stream
+    """
 
-    return [b64encode(h.digest()) for h in hashes]
+    def opener():
+        return open(filename, "rb", _BUFFERING)
+    return opener
 
 
-def file_chunk(filename, size=_BUFFERING):
+def zipentry_stream(zipfile, name):
     """
-    returns a generator function which when called will emit x-sized
-    chunks of filename's contents
+    returns a function which when called will open the named entry in
+    the zipfile object for reading and return the stream
     """
 
-    def chunks():
-        with open(filename, "rb", _BUFFERING) as fd:
-            buf = fd.read(size)
-            while buf:
-                yield buf
-                buf = fd.read(size)
-    return chunks
+    def opener():
+        return zipfile.open(name)
+    return opener
 
 
-def zipentry_chunk(zipfile, name, size=_BUFFERING):
+def digest_entries(entries, algorithms=(hashlib.md5, hashlib.sha1),
+                   workers=None):
     """
-    returns a generator function which when called will emit x-sized
-    chunks of the named entry in the zipfile object
+    yields (name, digests) for each of the (name, opener) pairs in
+    entries, in the same order, where digests is as returned from
+    digest_stream. The streams are opened in order, but are digested
+    by a pool of worker threads, one per CPU unless workers is
+    given. Since hashing large buffers releases the GIL, the workers
+    can digest several streams at once. No more than twice as many
+    streams as there are workers are open at a time.
     """
 
-    def chunks():
-        with zipfile.open(name) as fd:
-            buf = fd.read(size)
-            while buf:
-                yield buf
-                buf = fd.read(size)
-    return chunks
+    from multiprocessing import cpu_count
+
+    workers = workers or cpu_count()
+
+    if workers < 2:
+        buf = bytearray(_BUFFERING)
+        for name, opener in entries:
+            with opener() as stream:
+                yield name, digest_stream(stream, algorithms, buf)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    from threading import local, Lock
+
+    # each worker thread gets a read buffer of its own, to share
+    # between all the streams it digests
+    buffers = local()
+
+    # each stream waits in a list of its own until a worker claims it
+    # by taking it out, under this lock. Any left behind when we stop
+    # were never started on, and are ours to close.
+    claim = Lock()
+
+    def digest(task):
+        with claim:
+            if not task:
+                return None
+            stream = task.pop()
+
+        buf = getattr(buffers, "buf", None)
+        if buf is None:
+            buf = buffers.buf = bytearray(_BUFFERING)
+        with stream:
+            return digest_stream(stream, algorithms, buf)
+
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for name, opener in entries:
+            task = [opener()]
+            pending.append((name, task, pool.apply_async(digest, (task,))))
+            if len(pending) >= workers * 2:
+                name, _task, result = pending.popleft()
+                yield name, result.get()
+
+        while pending:
+            name, _task, result = pending.popleft()
+            yield name, result.get()
+
+    finally:
+        pool.terminate()
+
+        # if we stopped early, close the streams that no worker has
+        # claimed. Those that were claimed are closed by their worker
+        # once it's done with them.
+        with claim:
+            unclaimed = [task.pop() for _name, task, _result in pending
+                         if task]
+
+        for stream in unclaimed:
+            try:
+                stream.close()
+            except Exception:
+                # carry on closing the rest, and don't mask whatever
+                # error may have brought us here
+                pass
 
 
 def directory_generator(dirname, trim=0):
     """
-    yields a tuple of (relative filename, chunking function). The
-    chunking function can be called to open and iterate over the
-    contents of the filename.
+    yields a tuple of (relative filename, opener function). The opener
+    function can be called to open a stream over the contents of the
+    filename.
     """
 
-    def gather(collect, dirname, fnames):
+    for dirpath, _dirnames, fnames in walk(dirname):
         for fname in fnames:
-            df = join(dirname, fname)
-            if not isdir(df):
-                collect.append(df)
-
-    collect = list()
-    walk(dirname, gather, collect)
-    for fname in collect:
-        yield fname[trim:], file_chunk(fname)
+            df = join(dirpath, fname)
+            yield df[trim:], file_stream(df)
 
 
 def multi_path_generator(pathnames):
     """
-    yields (name,chunkgen) for all of the files found under the list
-    of pathnames given. This is recursive, so directories will have
-    their contents emitted. chunkgen is a function that can called and
-    iterated over to obtain the contents of the file in multiple
-    reads.
+    yields (name,opener) for all of the files found under the list of
+    pathnames given. This is recursive, so directories will have their
+    contents emitted. opener is a function that can be called to
+    obtain a stream over the contents of the file.
     """
 
     for pathname in pathnames:
@@ -816,7 +1075,7 @@ def multi_path_generator(pathnames):
             for entry in directory_generator(pathname):
                 yield entry
         else:
-            yield pathname, file_chunk(pathname)
+            yield pathname, file_stream(pathname)
 
 
 def file_is_signature_related(filename):
@@ -959,11 +1218,10 @@ def verify(certificate, jar_file, key_alias):
 
 def single_path_generator(pathname):
     """
-    emits name,chunkgen pairs for the given file at pathname. If
+    emits name,opener pairs for the given file at pathname. If
     pathname is a directory, will act recursively and will emit for
-    each file in the directory tree chunkgen is a generator that can
-    be iterated over to obtain the contents of the file in multiple
-    parts
+    each file in the directory tree. opener is a function that can be
+    called to obtain a stream over the contents of the file
     """
 
     if isdir(pathname):
@@ -977,7 +1235,7 @@ def single_path_generator(pathname):
         zf = ZipFile(pathname)
         for f in zf.namelist():
             if f[-1] != '/':
-                yield f, zipentry_chunk(zf, f)
+                yield f, zipentry_stream(zf, f)
         zf.close()
 
 
@@ -1008,20 +1266,21 @@ def cli_create(options, rest):
     else:
         entries = single_path_generator(rest[1])
 
-    mf = Manifest()
-
+    # skip the stuff that we were told to ignore
     ignores = options.ignore
+    if ignores:
+        entries = ((name, opener) for name, opener in entries
+                   if not fnmatches(name, *ignores))
+
+    mf = Manifest()
 
-    for name,chunks in entries:
-        # skip the stuff that we were told to ignore
-        if ignores and fnmatches(name, *ignores):
-            continue
+    digest_keys = [digest + "-Digest" for digest in requested_digests]
 
+    for name, digests in digest_entries(entries, use_digests):
         sec = mf.create_section(name)
 
-        for digest_name, digest_value in \
-            izip(requested_digests, digest_chunks(chunks(), use_digests)):
-            sec[digest_name + "-Digest"] = digest_value
+        for digest_key, digest_value in izip(digest_keys, digests):
+            sec[digest_key] = digest_value
 
     output = sys.stdout
     if options.manifest:
@@ -1113,7 +1372,7 @@ def cli_sign(options, rest):
     # style of the manifest it'll be digesting.
     sf = SignatureManifest(linesep=mf.linesep)
 
-    sf_digest_algorithm = options.digest or "SHA-256"
+    sf_digest_algorithm = options.digest or preferred_digest()
     sf.digest_manifest(mf, sf_digest_algorithm)
     jar_file.writestr("META-INF/%s.SF" % key_alias, sf.get_data())
 
@@ -1166,7 +1425,8 @@ def create_optparser():
                      help="with '-c/--create': comma-separated list of digest"
                      " algorithms to use in the manifest;\n"
                      "with '-s/--sign': digest algorithm to use"
-                     " in the signature")
+                     " in the signature, default is whichever of"
+                     " SHA-256 and SHA-512 is faster on this host")
     parse.add_option("-s", "--sign", action="store_true",
                      help="sign the JAR file with OpenSSL"
                      " (must be followed with: "
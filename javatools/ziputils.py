@@ -22,11 +22,19 @@ Utilities for discovering entry deltas in a pair of zip files.
 
 
 from cStringIO import StringIO
-from itertools import izip_longest
-from zipfile import is_zipfile, ZipFile, ZipInfo, _EndRecData
+from itertools import imap, izip
+from mmap import mmap, ACCESS_READ
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from operator import attrgetter
+from struct import unpack
+from zipfile import is_zipfile, BadZipfile, ZipFile, ZipInfo, _EndRecData
+from zipfile import sizeFileHeader, stringFileHeader, structFileHeader
+from zipfile import _FH_FILENAME_LENGTH, _FH_EXTRA_FIELD_LENGTH
 from zlib import crc32
-from os import walk
-from os.path import getsize, isdir, isfile, islink, join, relpath
+from os import fstat, lstat, walk
+from os.path import isdir, islink, join, relpath
+from stat import S_ISLNK, S_ISREG
 from .dirutils import LEFT, RIGHT, DIFF, SAME
 from .dirutils import closing
 
@@ -36,13 +44,31 @@ __all__ = (
     "open_zip", "open_zip_entry",
     "zip_file", "zip_entry_rollup",
     "LEFT", "RIGHT", "DIFF", "SAME",
+    "TRUST_CRC",
 )
 
 
-_CHUNKSIZE = 2 ** 14
+_CHUNKSIZE = 2 ** 20
 
 
-def compare(left, right):
+# whether entries with matching sizes and CRCs are taken to be the
+# same without comparing their contents, when a comparison isn't told
+# otherwise. A CRC32 only collides by accident once in 2**32, which
+# isn't worth reading both sides of every unchanged entry to rule out.
+TRUST_CRC = True
+
+
+# the index of the group in added, removed, altered, same which
+# collects each event yielded by compare_zips
+_EVENT_GROUPS = {
+    RIGHT: 0,
+    LEFT: 1,
+    DIFF: 2,
+    SAME: 3,
+}
+
+
+def compare(left, right, trust_crc=None):
     """
     yields EVENT,ENTRY pairs describing the differences between left
     and right, which are filenames for a pair of zip files
@@ -50,83 +76,221 @@ def compare(left, right):
 
     with open_zip(left) as l:
         with open_zip(right) as r:
-            return compare_zips(l, r)
+            return compare_zips(l, r, trust_crc)
 
 
-def compare_zips(left, right):
+def compare_zips(left, right, trust_crc=None):
     """
     yields EVENT,ENTRY pairs describing the differences between left
-    and right ZipFile instances
+    and right ZipFile instances. If trust_crc is true, entries with
+    the same size and CRC are the same, without their contents being
+    compared. It defaults to TRUST_CRC
     """
 
+    if trust_crc is None:
+        trust_crc = TRUST_CRC
+
     ll = set(left.namelist())
     rl = set(right.namelist())
+    common = ll.intersection(rl)
 
-    for f in ll:
-        if f in rl:
-            rl.remove(f)
+    _prefetch_crcs(left, right, common)
 
-            if (f[-1] == '/'):
-                # it's a directory entry
-                pass
-
-            elif _different(left, right, f):
-                yield DIFF, f
-
-            else:
-                yield SAME, f
+    for f in common:
+        if f[-1] == '/':
+            # directory entries are never reported
+            continue
 
+        if _different(left, right, f, left.getinfo(f), right.getinfo(f),
+                      trust_crc):
+            yield DIFF, f
         else:
-            yield LEFT, f
+            yield SAME, f
 
-    for f in rl:
+    for f in ll.difference(rl):
+        yield LEFT, f
+
+    for f in rl.difference(ll):
         yield RIGHT, f
 
 
-def _different(left, right, f):
+def _prefetch_crcs(left, right, names, workers=None):
     """
-    true if entry f is different between left and right ZipFile
-    instances
+    calculates ahead of time the CRCs that compare_zips is going to
+    need from either of left and right which is an ExplodedZipFile,
+    using a pool of workers threads, defaulting to one per CPU. Only
+    the entries in names that have the same size on both sides will
+    have their CRCs looked at, so only those are calculated. zlib
+    releases the GIL while checksumming, so the files really are
+    checksummed in parallel.
     """
 
-    l = left.getinfo(f)
-    r = right.getinfo(f)
+    if not (isinstance(left, ExplodedZipFile) or
+            isinstance(right, ExplodedZipFile)):
+        return
+
+    pending = []
+    for f in names:
+        if f[-1] == '/':
+            continue
+
+        l = left.getinfo(f)
+        r = right.getinfo(f)
+        if l.file_size == r.file_size:
+            pending.extend(i for i in (l, r)
+                           if isinstance(i, _ExplodedZipInfo) and
+                           i._crc is None)
+
+    if workers is None:
+        workers = cpu_count()
+
+    workers = min(workers, len(pending))
+    if workers < 2:
+        # the CRCs will be calculated as they're needed instead
+        return
+
+    # each info caches its own CRC once calculated
+    pool = ThreadPool(workers)
+    try:
+        pool.map(attrgetter("CRC"), pending)
+    finally:
+        pool.terminate()
+
+
+def _different(left, right, f, l, r, trust_crc=False):
+    """
+    true if entry f is different between left and right ZipFile
+    instances, given its ZipInfo l in left and r in right. If
+    trust_crc is true, a matching size and CRC is enough to decide
+    that they're the same.
+    """
 
     if (l.file_size == r.file_size) and (l.CRC == r.CRC):
-        # ok, they seem passibly similar, let's deep check them.
-        return _deep_different(left, right, f)
+        # ok, they seem passibly similar. If we trust that, or if they
+        # were compressed identically, we can skip inflating them,
+        # otherwise let's deep check them.
+        if trust_crc or _raw_same(left, right, l, r):
+            return False
+        else:
+            return _deep_different(left, right, f, l, r)
 
     else:
         # yup, they're different
         return True
 
 
-def _deep_different(left, right, entry):
+def _deep_different(left, right, entry, linfo, rinfo):
     """
     checks that entry is identical between ZipFile instances left and
-    right
+    right, given its ZipInfo linfo in left and rinfo in right
+    """
+
+    # the sizes and CRCs have already matched, so a digest of each
+    # side would tell us nothing new, and cost more to compute than
+    # comparing the data directly. Both sides are read into buffers
+    # allocated once up front, rather than into new strings per
+    # chunk. Small entries don't need a full chunk; the extra byte
+    # lets a single read notice if either side runs past its size.
+    size = min(_CHUNKSIZE, max(linfo.file_size, rinfo.file_size) + 1)
+    lbuf = bytearray(size)
+    rbuf = bytearray(size)
+    lview = memoryview(lbuf)
+    rview = memoryview(rbuf)
+
+    with open_zip_entry(left, entry) as lstream:
+        with open_zip_entry(right, entry) as rstream:
+            while True:
+                lcount = lstream.readinto(lbuf)
+                rcount = rstream.readinto(rbuf)
+
+                # comparing the views is a single memcmp over each
+                # chunk. Don't replace it with a loop over the bytes,
+                # and don't bother with numpy arrays for this either,
+                # as they would only be worth it if we wanted more
+                # than equality, eg. a count of the differing bytes.
+                if lcount != rcount or lview[:lcount] != rview[:rcount]:
+                    return True
+                elif not lcount:
+                    return False
+
+
+def _raw_same(left, right, linfo, rinfo):
+    """
+    true if the entries for ZipInfo linfo in left and rinfo in right
+    are stored using the same compression method and with the same
+    compressed bytes, which means their contents are the same as
+    well. False if they aren't, or if that can't be checked, in which
+    case their contents may still be the same.
+    """
+
+    if not (isinstance(left, ZipFile) and isinstance(right, ZipFile)):
+        return False
+
+    if (linfo.compress_type != rinfo.compress_type) or \
+       (linfo.compress_size != rinfo.compress_size) or \
+       ((linfo.flag_bits | rinfo.flag_bits) & 0x1):
+        # compressed differently, or encrypted
+        return False
+
+    loffset = _raw_offset(left, linfo)
+    roffset = _raw_offset(right, rinfo)
+    if loffset is None or roffset is None:
+        return False
+
+    # seek before every read, in case left and right share a file
+    remaining = linfo.compress_size
+    while remaining:
+        size = min(remaining, _CHUNKSIZE)
+
+        left.fp.seek(loffset)
+        ldata = left.fp.read(size)
+        right.fp.seek(roffset)
+        rdata = right.fp.read(size)
+
+        if len(ldata) != size or ldata != rdata:
+            return False
+
+        loffset += size
+        roffset += size
+        remaining -= size
+
+    return True
+
+
+def _raw_offset(zipfile, info):
     """
+    the offset of the compressed data for the entry described by
+    ZipInfo info in the ZipFile instance zipfile, found by reading the
+    entry's local file header. None if the header can't be read.
+    """
+
+    fp = zipfile.fp
+    if fp is None:
+        return None
 
-    left = chunk_zip_entry(left, entry)
-    right = chunk_zip_entry(right, entry)
+    fp.seek(info.header_offset)
+    header = fp.read(sizeFileHeader)
+    if len(header) != sizeFileHeader or \
+       header[0:4] != stringFileHeader:
+        return None
 
-    for ldata, rdata in izip_longest(left, right):
-        if ldata != rdata:
-            return True
-    return False
+    header = unpack(structFileHeader, header)
+    return info.header_offset + sizeFileHeader + \
+        header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH]
 
 
-def collect_compare(left, right):
+def collect_compare(left, right, trust_crc=None):
     """
     collects the differences between left and right, which are
     filenames for valid zip files, into a tuple of lists: added,
     removed, altered, same
     """
 
-    return collect_compare_into(left, right, [], [], [], [])
+    return collect_compare_into(left, right, [], [], [], [], trust_crc)
 
 
-def collect_compare_into(left, right, added, removed, altered, same):
+def collect_compare_into(left, right, added, removed, altered, same,
+                         trust_crc=None):
     """
     collects the differences between left and right, which are
     filenames for valid zip files, into the lists added, removed,
@@ -138,39 +302,38 @@ def collect_compare_into(left, right, added, removed, altered, same):
         with open_zip(right) as r:
             return collect_compare_zips_into(l, r,
                                              added, removed,
-                                             altered, same)
+                                             altered, same,
+                                             trust_crc)
 
 
-def collect_compare_zips(left, right):
+def collect_compare_zips(left, right, trust_crc=None):
     """
     collects the differences between left and right ZipFile instances
     into a tuple of lists: added, removed, altered, same
     """
 
-    return collect_compare_zips_into(left, right, [], [], [], [])
+    return collect_compare_zips_into(left, right, [], [], [], [],
+                                     trust_crc)
 
 
-def collect_compare_zips_into(left, right, added, removed, altered, same):
+def collect_compare_zips_into(left, right, added, removed, altered, same,
+                              trust_crc=None):
     """
     collects the differences between left and right ZipFile instances
     into the lists added, removed, altered, and same.  Returns a tuple
     of added, removed, altered, same
     """
 
-    for event,filename in compare_zips(left, right):
-        if event == LEFT:
-            group = removed
-        elif event == RIGHT:
-            group = added
-        elif event == DIFF:
-            group = altered
-        elif event == SAME:
-            group = same
-        else:
-            assert(False)
+    # gather the events into lists of our own, and hand each over to
+    # its group in a single extend
+    found = ([], [], [], [])
+
+    for event,filename in compare_zips(left, right, trust_crc):
+        found[_EVENT_GROUPS[event]].append(filename)
 
+    for group, filenames in izip((added, removed, altered, same), found):
         if group is not None:
-            group.append(filename)
+            group.extend(filenames)
 
     return added,removed,altered,same
 
@@ -209,46 +372,90 @@ def is_zipstream(data):
     return result
 
 
-def file_crc32(filename, chunksize=_CHUNKSIZE):
+def file_crc32(filename):
     """
-    calculate the CRC32 of the contents of filename
+    calculate the CRC32 of the contents of filename. The result is
+    unsigned, as found in the CRC field of a ZipInfo
     """
 
-    check = 0
     with open(filename, 'rb') as fd:
-        for data in iter(lambda:fd.read(chunksize), ""):
-            check = crc32(data, check)
-    return check
+        if not fstat(fd.fileno()).st_size:
+            # mmap refuses to map an empty file
+            return 0
+
+        # map the file so that zlib can checksum the whole of it in a
+        # single call
+        data = mmap(fd.fileno(), 0, access=ACCESS_READ)
+        try:
+            return crc32(data) & 0xffffffff
+        finally:
+            data.close()
+
+
+class _ExplodedZipInfo(ZipInfo):
+    """
+    ZipInfo for a file in an ExplodedZipFile. The CRC of the file
+    isn't calculated until it's first asked for, as many entries
+    (eg. those only present on one side of a comparison) never need
+    it.
+    """
+
+    __slots__ = ("_path", "_crc")
+
+
+    def __init__(self, path, *args, **kwds):
+        ZipInfo.__init__(self, *args, **kwds)
+        self._path = path
+        self._crc = None
 
 
-def _collect_infos(dirname):
+    def _get_crc(self):
+        if self._crc is None:
+            self._crc = file_crc32(self._path)
+        return self._crc
 
-    """ Utility function used by ExplodedZipFile to generate ZipInfo
-    entries for all of the files and directories under dirname """
+
+    def _set_crc(self, crc):
+        self._crc = crc
+
+
+    CRC = property(_get_crc, _set_crc)
+
+
+def _collect_infos(dirname, out):
+
+    """ Utility function used by ExplodedZipFile to collect ZipInfo
+    entries for all of the files and directories under dirname into
+    the dict out, keyed by their names """
 
     for r, _ds, fs in walk(dirname):
-        if not islink(r) and r != dirname:
+        reldir = relpath(r, dirname) if r != dirname else ""
+
+        if reldir and not islink(r):
             i = ZipInfo()
-            i.filename = join(relpath(r, dirname), "")
+            i.filename = join(reldir, "")
             i.file_size = 0
             i.compress_size = 0
             i.CRC = 0
-            yield i.filename, i
+            out[i.filename] = i
 
         for f in fs:
             df = join(r, f)
-            relfn = relpath(join(r, f), dirname)
 
-            if islink(df):
+            # a single lstat tells us both what the file is and its
+            # size, where islink, isfile, and getsize would each stat
+            # it again
+            st = lstat(df)
+
+            if S_ISLNK(st.st_mode):
                 pass
 
-            elif isfile(df):
-                i = ZipInfo()
-                i.filename = relfn
-                i.file_size = getsize(df)
+            elif S_ISREG(st.st_mode):
+                i = _ExplodedZipInfo(df)
+                i.filename = join(reldir, f)
+                i.file_size = st.st_size
                 i.compress_size = i.file_size
-                i.CRC = file_crc32(df)
-                yield i.filename, i
+                out[i.filename] = i
 
             else:
                 # TODO: is there any more special treatment?
@@ -266,11 +473,18 @@ class ExplodedZipFile(object):
         self.fn = pathname
         self.filename = pathname
         self.members = None
+        self._namelist = None
+        self._infolist = None
         self.refresh()
 
 
     def refresh(self):
-        self.members = dict(_collect_infos(self.fn))
+        self.members = {}
+        _collect_infos(self.fn, self.members)
+
+        # the members only change here, so list them just once
+        self._namelist = sorted(self.members)
+        self._infolist = self.members.values()
 
 
     def getinfo(self, name):
@@ -278,24 +492,30 @@ class ExplodedZipFile(object):
 
 
     def namelist(self):
-        return sorted(self.members.keys())
+        return self._namelist
 
 
     def infolist(self):
-        return self.members.values()
+        return self._infolist
 
 
     def open(self, name, mode='rb'):
-        return open(join(self.fn, name), mode)
+        return open(join(self.fn, name), mode, _CHUNKSIZE)
 
 
     def read(self, name):
-        with self.open(name) as fd:
-            return fd.read()
+        with open(join(self.fn, name), 'rb', 0) as fd:
+            # read the whole file in one call, sized by what's on disk
+            # now, then pick up anything that's been added since
+            data = fd.read(fstat(fd.fileno()).st_size)
+            more = fd.read()
+            return (data + more) if more else data
 
 
     def close(self):
         self.members = None
+        self._namelist = None
+        self._infolist = None
 
 
 def zip_file(fn, mode="r"):
@@ -307,10 +527,19 @@ def zip_file(fn, mode="r"):
 
     if isdir(fn):
         return ExplodedZipFile(fn)
+
+    elif mode == "r":
+        # reading the central directory is all is_zipfile would do,
+        # so skip straight to that rather than opening fn twice
+        try:
+            return ZipFile(fn, mode)
+        except (BadZipfile, IOError):
+            pass
+
     elif is_zipfile(fn):
         return ZipFile(fn, mode)
-    else:
-        raise Exception("cannot treat as an archive: %r" % fn)
+
+    raise Exception("cannot treat as an archive: %r" % fn)
 
 
 def open_zip(filename, mode="r"):
@@ -361,17 +590,17 @@ def zip_entry_rollup(zipfile):
     size_compressed). files+dirs will equal len(zipfile.infolist)
     """
 
-    files = dirs = 0
-    total_c = total_u = 0
+    infos = zipfile.infolist()
 
-    for i in zipfile.infolist():
-        if i.filename[-1] == '/':
-            # I wonder if there's a better detection method than this
-            dirs += 1
-        else:
-            files += 1
-            total_c += i.compress_size
-            total_u += i.file_size
+    # I wonder if there's a better detection method than this
+    file_infos = [i for i in infos if i.filename[-1] != '/']
+
+    files = len(file_infos)
+    dirs = len(infos) - files
+
+    # summing each column in its own pass keeps the loops in C
+    total_c = sum(imap(attrgetter("compress_size"), file_infos))
+    total_u = sum(imap(attrgetter("file_size"), file_infos))
 
     return files, dirs, total_c, total_u
 
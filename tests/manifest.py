@@ -23,9 +23,18 @@ license: LGPL v.3
 
 from . import get_data_fn
 from javatools.manifest import main, Manifest, SignatureManifest, verify
-
-from shutil import copyfile
-from tempfile import NamedTemporaryFile
+from javatools.manifest import preferred_digest, MalformedManifest
+from javatools.manifest import ManifestKeyException
+from javatools.manifest import digest_entries, single_path_generator
+from javatools.manifest import file_stream
+from javatools.manifest import detect_linesep, parse_sections
+
+from io import BytesIO
+from os import urandom
+from os.path import join
+from shutil import copyfile, rmtree
+from tempfile import NamedTemporaryFile, mkdtemp
+from time import sleep
 from unittest import TestCase
 
 
@@ -127,6 +136,134 @@ class ManifestTest(TestCase):
         self.assertEqual(mf.linesep, "\r\n")
 
 
+    def test_digest_entries_threaded(self):
+        src_jar = get_data_fn("manifest-sample1.jar")
+
+        serial = digest_entries(single_path_generator(src_jar), workers=1)
+        threaded = digest_entries(single_path_generator(src_jar), workers=4)
+        self.assertEqual(list(threaded), list(serial))
+
+
+    def test_digest_entries_stopped_early(self):
+        streams = []
+
+        def opener():
+            stream = BytesIO("data" * 1000)
+            streams.append(stream)
+            return stream
+
+        entries = ((str(i), opener) for i in xrange(20))
+        digests = digest_entries(entries, workers=2)
+        next(digests)
+        digests.close()
+
+        # nothing is left open by the digests that never ran
+        self.assertTrue(streams)
+        self.assertTrue(all(stream.closed for stream in streams))
+
+
+    def test_digest_entries_stopped_early_files(self):
+        # files large enough that the workers are still reading them
+        # when we stop, which is when they release the GIL
+        tmpdir = mkdtemp()
+        try:
+            block = urandom(2 ** 20)
+            streams = []
+            entries = []
+
+            for i in xrange(6):
+                fn = join(tmpdir, str(i))
+                with open(fn, "wb") as fd:
+                    for _ in xrange(16):
+                        fd.write(block)
+
+                def opener(opener=file_stream(fn)):
+                    stream = opener()
+                    streams.append(stream)
+                    return stream
+
+                entries.append((fn, opener))
+
+            digests = digest_entries(iter(entries), workers=2)
+            next(digests)
+            digests.close()
+
+            # the workers close the streams they were part way
+            # through once they're done with them
+            for _ in xrange(200):
+                if all(stream.closed for stream in streams):
+                    break
+                sleep(0.05)
+
+            self.assertTrue(all(stream.closed for stream in streams))
+
+        finally:
+            rmtree(tmpdir)
+
+
+    def test_signature_bad_key(self):
+        sf = SignatureManifest()
+        sf["Signature-Version"] = "1.0"
+        sf[""] = "no key"
+
+        # the bad key is caught before openssl gets to sign anything
+        self.assertRaises(ManifestKeyException, sf.get_signature,
+                          get_data_fn("javatools-cert.pem"),
+                          get_data_fn("javatools.pem"))
+
+
+    def test_parse_continuations(self):
+        mf = Manifest()
+        mf.parse("Manifest-Version: 1.0\r\n"
+                 "Long: abc\r\n def\r\n \r\n ghi\r\n"
+                 "\r\n\r\n"
+                 "Name: example.txt\r\n"
+                 "Key: value\r\n")
+
+        self.assertEqual(mf.get("Long"), "abcdefghi")
+        self.assertEqual(mf.sub_sections["example.txt"].get("Key"), "value")
+
+        # a value that starts on the line after its key
+        mf = Manifest()
+        mf.parse("Manifest-Version: 1.0\nClass-Path:\n lib/a.jar\n")
+        self.assertEqual(mf.get("Class-Path"), "lib/a.jar")
+
+
+    def test_parse_sections_stream(self):
+        data = "Manifest-Version: 1.0\rLong: abc\r def\r\rName: a\rKey: v\r"
+
+        self.assertEqual(detect_linesep(BytesIO(data)), "\r")
+        self.assertEqual(list(parse_sections(BytesIO(data))),
+                         list(parse_sections(data)))
+        self.assertEqual(list(parse_sections(data)),
+                         [[("Manifest-Version", ["1.0"]),
+                           ("Long", ["abcdef"])],
+                          [("Name", ["a"]), ("Key", ["v"])]])
+
+
+    def test_parse_bad_continuation(self):
+        mf = Manifest()
+        self.assertRaises(MalformedManifest, mf.parse,
+                          "Manifest-Version: 1.0\n\n continued\n")
+
+
+    def test_data_follows_changes(self):
+        mf = Manifest()
+        sect = mf.create_section("example.txt")
+        sect["Key"] = "before"
+        self.assertIn("Key: before", sect.get_data())
+        self.assertIn("Key: before", mf.get_data())
+
+        sect["Key"] = "after"
+        mf["Created-By"] = "javatools"
+        self.assertIn("Key: after", sect.get_data())
+        self.assertIn("Key: after", mf.get_data())
+        self.assertIn("Created-By: javatools", mf.get_main_section())
+
+        del sect["Key"]
+        self.assertNotIn("Key:", mf.get_data())
+
+
     def test_verify_signature_by_javatools(self):
         self.verify_signature("manifest-signed.jar")
 
@@ -157,6 +294,11 @@ class ManifestTest(TestCase):
                               "Verification of JAR which we just signed failed: %s"
                               % error_message)
 
+    def test_preferred_digest(self):
+        self.assertIn(preferred_digest(), ("SHA-256", "SHA-512"))
+        self.assertEqual(preferred_digest(), preferred_digest())
+
+
     def test_verify_mf_checksums_no_whole_digest(self):
         sf_file = "sf-no-whole-digest.sf"
         mf_file = "sf-no-whole-digest.mf"
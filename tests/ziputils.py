@@ -0,0 +1,260 @@
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+unit tests for javatools.ziputils
+
+author: Christopher O'Brien  <obriencj@gmail.com>
+license: LGPL v.3
+"""
+
+
+from . import get_data_fn
+from javatools.ziputils import ExplodedZipFile, file_crc32
+from javatools.ziputils import compare_zips, _deep_different, _prefetch_crcs
+from javatools.ziputils import collect_compare, collect_compare_into
+from javatools.ziputils import LEFT, RIGHT, DIFF, SAME
+from javatools.ziputils import zip_entry_rollup, zip_file
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+
+class ExplodedZipFileTest(TestCase):
+
+
+    def setUp(self):
+        self.src_jar = get_data_fn("manifest-sample2.jar")
+        self.tmpdir = mkdtemp()
+
+        with ZipFile(self.src_jar) as zf:
+            zf.extractall(self.tmpdir)
+
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+
+    def test_file_crc32(self):
+        with ZipFile(self.src_jar) as zf:
+            for info in zf.infolist():
+                if info.filename[-1] == '/':
+                    continue
+
+                fn = join(self.tmpdir, info.filename)
+                self.assertEqual(file_crc32(fn), info.CRC,
+                                 "CRC mismatch for %s" % info.filename)
+
+
+    def test_file_crc32_empty(self):
+        fn = join(self.tmpdir, "empty")
+        open(fn, "wb").close()
+        self.assertEqual(file_crc32(fn), 0)
+
+
+    def test_compare_exploded(self):
+        with ZipFile(self.src_jar) as zf:
+            exploded = ExplodedZipFile(self.tmpdir)
+            events = dict((f, e) for e, f in compare_zips(zf, exploded))
+
+        for name, event in events.items():
+            if name[-1] != '/':
+                self.assertEqual(event, SAME, "%s is %s" % (name, event))
+
+
+    def test_lazy_crc(self):
+        exploded = ExplodedZipFile(self.tmpdir)
+        info = exploded.getinfo("example.txt")
+
+        # nothing has been checksummed yet
+        self.assertEqual(info._crc, None)
+
+        with ZipFile(self.src_jar) as zf:
+            self.assertEqual(info.CRC, zf.getinfo("example.txt").CRC)
+        self.assertEqual(info._crc, info.CRC)
+
+
+    def test_read(self):
+        exploded = ExplodedZipFile(self.tmpdir)
+        with ZipFile(self.src_jar) as zf:
+            for name in exploded.namelist():
+                if name[-1] != '/':
+                    self.assertEqual(exploded.read(name), zf.read(name))
+
+        # the size comes from the file, not from the older listing
+        fn = join(self.tmpdir, "example.txt")
+        with open(fn, "rb") as fd:
+            data = fd.read()
+        with open(fn, "ab") as fd:
+            fd.write("more")
+        self.assertEqual(exploded.read("example.txt"), data + "more")
+
+
+    def test_prefetch_crcs(self):
+        with open(join(self.tmpdir, "extra.txt"), "wb") as fd:
+            fd.write("only on one side")
+
+        exploded = ExplodedZipFile(self.tmpdir)
+        with ZipFile(self.src_jar) as zf:
+            names = set(zf.namelist()).intersection(exploded.namelist())
+            _prefetch_crcs(zf, exploded, names, workers=2)
+
+            for name in names:
+                if name[-1] != '/':
+                    info = exploded.getinfo(name)
+                    self.assertEqual(info._crc, zf.getinfo(name).CRC)
+
+        # entries that aren't on both sides are left alone
+        self.assertEqual(exploded.getinfo("extra.txt")._crc, None)
+
+
+    def test_zip_file(self):
+        self.assertTrue(isinstance(zip_file(self.tmpdir), ExplodedZipFile))
+
+        zf = zip_file(self.src_jar)
+        self.assertTrue(isinstance(zf, ZipFile))
+        zf.close()
+
+        fn = join(self.tmpdir, "example.txt")
+        self.assertRaises(Exception, zip_file, fn)
+        self.assertRaises(Exception, zip_file, fn + ".missing")
+
+
+    def test_trust_crc(self):
+        fn = join(self.tmpdir, "example.txt")
+        with open(fn, "rb") as fd:
+            data = fd.read()
+        with open(fn, "wb") as fd:
+            fd.write(data[::-1])
+
+        with ZipFile(self.src_jar) as zf:
+            exploded = ExplodedZipFile(self.tmpdir)
+
+            # pretend the altered file's CRC collides with the original
+            exploded.getinfo("example.txt").CRC = \
+                zf.getinfo("example.txt").CRC
+
+            events = dict((f, e) for e, f in compare_zips(zf, exploded))
+            self.assertEqual(events["example.txt"], SAME)
+
+            events = dict((f, e) for e, f in
+                          compare_zips(zf, exploded, trust_crc=False))
+            self.assertEqual(events["example.txt"], DIFF)
+
+
+    def test_deep_different(self):
+        fn = join(self.tmpdir, "example.txt")
+        with ZipFile(self.src_jar) as zf:
+            exploded = ExplodedZipFile(self.tmpdir)
+            infos = (zf.getinfo("example.txt"),
+                     exploded.getinfo("example.txt"))
+            self.assertFalse(_deep_different(zf, exploded, "example.txt",
+                                             *infos))
+
+            with open(fn, "ab") as fd:
+                fd.write("more")
+            self.assertTrue(_deep_different(zf, exploded, "example.txt",
+                                            *infos))
+
+
+class CompareZipsTest(TestCase):
+
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+
+    def write_zip(self, name, entries, compression=ZIP_DEFLATED):
+        fn = join(self.tmpdir, name)
+        with ZipFile(fn, "w", compression) as zf:
+            for entry_name, data in entries:
+                zf.writestr(entry_name, data)
+        return fn
+
+
+    def compare(self, left, right, trust_crc=None):
+        with ZipFile(left) as lz:
+            with ZipFile(right) as rz:
+                return sorted((f, e) for e, f in
+                              compare_zips(lz, rz, trust_crc))
+
+
+    def test_same_jar(self):
+        src_jar = get_data_fn("manifest-sample2.jar")
+        for name, event in self.compare(src_jar, src_jar, False):
+            if name[-1] != '/':
+                self.assertEqual(event, SAME, "%s is %s" % (name, event))
+
+
+    def test_compression_differs(self):
+        entries = [("a.txt", "a" * 1000), ("b.txt", "hello")]
+        left = self.write_zip("left.zip", entries, ZIP_STORED)
+        right = self.write_zip("right.zip", entries, ZIP_DEFLATED)
+
+        self.assertEqual(self.compare(left, right, False),
+                         [("a.txt", SAME), ("b.txt", SAME)])
+
+
+    def test_added_removed(self):
+        left = self.write_zip("left.zip", [("a.txt", "a"), ("b.txt", "b")])
+        right = self.write_zip("right.zip", [("b.txt", "b"), ("c.txt", "c")])
+
+        self.assertEqual(self.compare(left, right),
+                         [("a.txt", LEFT), ("b.txt", SAME), ("c.txt", RIGHT)])
+
+
+    def test_rollup(self):
+        with ZipFile(get_data_fn("manifest-sample2.jar")) as zf:
+            files, dirs, total_c, total_u = zip_entry_rollup(zf)
+            infos = zf.infolist()
+
+        self.assertEqual((files, dirs), (5, 1))
+        self.assertEqual(total_c, sum(i.compress_size for i in infos))
+        self.assertEqual(total_u, sum(i.file_size for i in infos))
+
+
+    def test_content_differs(self):
+        left = self.write_zip("left.zip", [("a.txt", "left")])
+        right = self.write_zip("right.zip", [("a.txt", "right")])
+
+        self.assertEqual(self.compare(left, right), [("a.txt", DIFF)])
+
+
+    def test_collect_compare(self):
+        left = self.write_zip("left.zip", [("a.txt", "a"), ("b.txt", "b"),
+                                           ("d.txt", "left")])
+        right = self.write_zip("right.zip", [("b.txt", "b"), ("c.txt", "c"),
+                                             ("d.txt", "right")])
+
+        self.assertEqual(collect_compare(left, right),
+                         (["c.txt"], ["a.txt"], ["d.txt"], ["b.txt"]))
+
+        # groups given as None are left out, and existing entries in
+        # the others are kept
+        added = ["x.txt"]
+        self.assertEqual(collect_compare_into(left, right,
+                                              added, None, None, []),
+                         (["x.txt", "c.txt"], None, None, ["b.txt"]))
+
+
+#
+# The end.